@@ -1,21 +1,57 @@
 #!/usr/bin/env python3
 
-from fastapi import FastAPI, HTTPException
-from remotezip import RemoteZip
+from fastapi import FastAPI, HTTPException, Response
+from lxml import etree
 from typing import Optional
 
 import aiohttp
 import aiopath
 import aiosqlite
 import asyncio
+import base64
+import collections
+import concurrent.futures
+import datetime
+import functools
+import multiprocessing
+import operator
+import orjson
 import plistlib
 import re
+import string
+import struct
 import time
-import ujson
 import wikitextparser as wtp
+import zlib
 
 DB_PATH = aiopath.AsyncPath('betas.db')
-DEVICE_REGEX = re.compile(r'(iPhone|AppleTV|iPad|iPod)[0-9]+,[0-9]+')
+DEVICE_PREFIXES = ('iPhone', 'AppleTV', 'iPad', 'iPod')
+BUILDID_REGEX = re.compile(r'=\s*([A-Za-z0-9]+)')
+SIZE_REGEX = re.compile(r'(?<!\S)[0-9][0-9,]*(?!\S)')
+URL_REGEX = re.compile(r'''https?://[^\s\[\]<>"'{}|]+''')  # Stops at template pipes
+COMMENT_REGEX = re.compile(r'<!--.*?(?:-->|$)', re.DOTALL)  # Unclosed: to the end
+
+WIKI_API = 'https://www.theiphonewiki.com/w/api.php'
+WIKI_TITLE_LIMIT = 50  # Most titles MediaWiki accepts in a single query
+
+IPSW_API = 'https://api.ipsw.me/v4/devices'
+IPSW_API_TTL = 300  # Seconds to reuse the ipsw.me device list before revalidating
+IPSW_API_CACHE = aiopath.AsyncPath('devices.json')
+IPSW_API_CACHE_TTL = 86400  # Oldest copy left by a previous run that's still loaded
+IPSW_API_VALIDATORS = (
+    ('If-None-Match', 'ETag'),
+    ('If-Modified-Since', 'Last-Modified'),
+)  # Request header, response header
+
+SCRAPE_INTERVAL = IPSW_API_TTL  # Seconds between scrape cycles, no point going faster
+
+ZIP_TAIL_SIZE = 0x20000  # Enough to cover the central directory of an IPSW
+ZIP_EOCD = struct.Struct('<4s4H2LH')
+ZIP_CD_ENTRY = struct.Struct('<4s6H3L5H2L')
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+ZIP64_EOCD_LOCATOR = struct.Struct('<4sLQL')
+ZIP64_EOCD = struct.Struct('<4sQ2H2L4Q')
+ZIP64_EXTRA_ID = 0x0001
 
 TATSU_API = 'http://gs.apple.com/TSS/controller'
 TATSU_HEADERS = {
@@ -24,6 +60,7 @@ TATSU_HEADERS = {
     'User-Agent': 'InetURL/1.0',
 }
 TATSU_PARAMS = {'action': 2}
+TATSU_CACHE_TTL = 900  # Seconds to trust a signing status before asking Tatsu again
 TATSU_REQUEST = {
     'ApChipID': 0,
     'ApBoardID': 0,
@@ -34,190 +71,563 @@ TATSU_REQUEST = {
     'UniqueBuildID': bytes(),
 }
 
+PLIST_PARSER = etree.XMLParser(
+    huge_tree=True,
+    remove_blank_text=True,
+    remove_comments=True,
+    resolve_entities=False,
+)
+
+
+def _plist_dict(elem: etree._Element) -> dict:
+    children = iter(elem)
+    return {
+        key.text or '': _plist_value(value) for key, value in zip(children, children)
+    }
+
+
+def _plist_integer(elem: etree._Element) -> int:
+    text = elem.text.strip()
+    return int(text, 16) if text.lower().startswith('0x') else int(text)
+
+
+_PLIST_CONVERT = {
+    'dict': _plist_dict,
+    'array': lambda elem: [_plist_value(child) for child in elem],
+    'string': lambda elem: elem.text or '',
+    'integer': _plist_integer,
+    'real': lambda elem: float(elem.text),
+    'true': lambda elem: True,
+    'false': lambda elem: False,
+    'data': lambda elem: base64.b64decode(elem.text or ''),
+    'date': lambda elem: datetime.datetime.strptime(elem.text, '%Y-%m-%dT%H:%M:%SZ'),
+}
+
+
+def _plist_value(elem: etree._Element):
+    return _PLIST_CONVERT[elem.tag](elem)
+
+
+def _fast_plist_loads(data: bytes):
+    if data[:6] == b'bplist':
+        return plistlib.loads(data, fmt=plistlib.FMT_BINARY)
+
+    try:
+        return _plist_value(etree.fromstring(data, parser=PLIST_PARSER)[0])
+    except Exception:  # Let plistlib handle anything lxml can't
+        return plistlib.loads(data, fmt=plistlib.FMT_XML)
+
+
+def _zip64_entry_info(entry: tuple, extra: bytes) -> tuple:
+    comp_size, uncomp_size, offset = entry[8], entry[9], entry[16]
+
+    pos = 0
+    while pos + 4 <= len(extra):
+        header_id, size = struct.unpack_from('<2H', extra, pos)
+        if header_id == ZIP64_EXTRA_ID:  # Only fields that overflowed are present
+            values = iter(struct.unpack_from(f'<{size // 8}Q', extra, pos + 4))
+            if uncomp_size == 0xFFFFFFFF:
+                uncomp_size = next(values)
+            if comp_size == 0xFFFFFFFF:
+                comp_size = next(values)
+            if offset == 0xFFFFFFFF:
+                offset = next(values)
+
+            break
+
+        pos += 4 + size
+
+    return comp_size, offset
+
+
+def _zip_local_data(local: bytes, comp_size: int) -> Optional[bytes]:
+    if len(local) < ZIP_LOCAL_HEADER.size:
+        return None
+
+    *_, name_len, extra_len = ZIP_LOCAL_HEADER.unpack_from(local)
+    data_start = ZIP_LOCAL_HEADER.size + name_len + extra_len
+    if len(local) < data_start + comp_size:  # Entry runs past the end of the buffer
+        return None
+
+    return local[data_start : data_start + comp_size]
+
+
+def _device_token(text: str) -> Optional[str]:  # e.g. 'iPhone14,2'
+    for prefix in DEVICE_PREFIXES:
+        if text.startswith(prefix):
+            break
+    else:
+        return None
+
+    major, sep, minor = text[len(prefix) :].partition(',')
+    # Keep only the minor number's leading digits, so 'iPad7,11 Wi-Fi' -> '11'
+    minor = minor[: len(minor) - len(minor.lstrip(string.digits))]
+    if not major or major.strip(string.digits) or not minor:
+        return None
+
+    return f'{prefix}{major},{minor}'
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_cell(cell: str) -> wtp.WikiText:  # Cells often repeat across pages
+    return wtp.parse(cell)
+
+
+# The regex has to find the same links the parser would, in the same order
+for _cell in (
+    '{{dl|https://example.com/a.ipsw|label}}',
+    '<!-- https://example.com/old.ipsw --> [https://example.com/a.ipsw label]',
+    '[https://example.com/a.ipsw a]<br />[https://example.com/b.ipsw b]',
+):
+    assert URL_REGEX.findall(COMMENT_REGEX.sub('', _cell)) == [
+        link.url for link in _parse_cell(_cell).external_links
+    ], _cell
+
+
+def parse_wikitext(wikitext: str) -> list:  # i hate this entire function
+    firms = list()
+    page_text = wtp.parse(wikitext)
+    for table in page_text.tables:
+        rows = table.data()  # wikitextparser re-parses the table on every call
+        template = rows[0]
+        codename_index = next(
+            (i for i, x in enumerate(template) if 'Codename' in x or 'Keys' in x),
+            None,
+        )  # Same for every row of the table
+        if codename_index is None:  # Not a firmware table
+            continue
+
+        for row in rows[1:]:
+            firm_data = [x for x in row if x is not None]
+            devices = [
+                identifier
+                for device in _parse_cell(firm_data[codename_index]).wikilinks
+                if (text := device.text) is not None  # Recomputed on every access
+                and (identifier := _device_token(text)) is not None
+            ]
+
+            version = firm_data[0]
+            for link in _parse_cell(firm_data[0]).wikilinks:
+                if link.text is not None:
+                    version = version.replace(str(link), link.text)
+
+            # Can't use the mediawiki parser for this, unfortunately
+            buildids = BUILDID_REGEX.findall(firm_data[1]) or [firm_data[1]]
+
+            urls = next(
+                (
+                    found
+                    for cell in firm_data
+                    if (found := URL_REGEX.findall(COMMENT_REGEX.sub('', cell)))
+                ),
+                None,
+            )  # Much cheaper than parsing every cell for its external links
+            if urls is None:  # Let the parser find any links the regex can't
+                ipsws = next(
+                    (
+                        links
+                        for cell in firm_data
+                        if (links := _parse_cell(cell).external_links)
+                    ),
+                    None,
+                )
+                if not ipsws:  # No URLs for this firmware, skip
+                    continue
+
+                urls = [ipsw.url for ipsw in ipsws]
+
+            if not any(
+                url.endswith('.ipsw') for url in urls
+            ):  # Only IPSW beta firmwares are scraped
+                continue
+
+            ipsw_sizes = [
+                size
+                for size in (
+                    int(word.replace(',', ''))
+                    for word in SIZE_REGEX.findall(firm_data[-1])
+                )
+                if size > 10
+            ]
+
+            if len(ipsw_sizes) != len(
+                urls
+            ):  # One or more IPSWs don't have filesizes, skip
+                continue
+
+            for d in range(len(devices)):
+                firm_index = (
+                    0
+                    if ((len(devices) == 4) and (d in (0, 1)))
+                    or ((len(devices) == 2) and (d == 0))
+                    else 1
+                )
+                ipsw_index = firm_index if len(urls) > 1 else 0
+
+                firm = {  # Each device gets its own dict
+                    'version': version,
+                    'identifier': devices[d],
+                    'buildid': buildids[firm_index if len(buildids) > 1 else 0],
+                    'url': urls[ipsw_index],
+                    'filesize': ipsw_sizes[ipsw_index],
+                }
+
+                firms.append(firm)
+
+    return firms
+
 
 class WikiScraper:
+    # Shared across scrape cycles, as a new scraper is created for each one
+    _ipsw_api = None
+    _ipsw_api_validators = dict()  # Conditional request headers for revalidation
+    _ipsw_devices = None  # Maps casefolded identifiers to ipsw.me device info
+    _ipsw_api_time = 0
+    _ipsw_api_lock = None  # Created on first use, so it belongs to the running loop
+    # (ApChipID, ApBoardID, IPSW URL) -> (time, signed), signed is None if unchecked
+    _tatsu_cache = dict()
+    _page_cache = dict()  # Page title -> (touched timestamp, parsed firmwares)
+    _output_cache = dict()  # Lowercased identifier -> firmwares last written to betas
+
     def __init__(
-        self, session: aiohttp.ClientSession, db: aiosqlite.Connection
+        self,
+        session: aiohttp.ClientSession,
+        db: aiosqlite.Connection,
+        pool: concurrent.futures.Executor,
     ) -> None:
         self.session = session
         self.db = db
-        self.http_semaphore = asyncio.Semaphore(
-            100
-        )  # Only allow 100 simultaneous HTTP requests
-        self.pages = list()
-        self.api = dict()
-        self.ipsw_api = None
-
-    async def get_pages(self, product_type: str) -> list:
+        self.pool = pool  # Runs wikitext parsing
+        self.pages = dict()  # Page title -> touched timestamp
+        self.api = collections.defaultdict(list)
+        self.buildids = collections.defaultdict(set)  # Buildids in self.api per device
+        self.identities = dict()  # IPSW URLs -> tasks loading their build identities
+
+    @staticmethod
+    def prune_tatsu_cache() -> None:  # Called once per scrape cycle
+        now = time.time()
+        for key, cached in list(WikiScraper._tatsu_cache.items()):
+            if now - cached[0] >= TATSU_CACHE_TTL:
+                del WikiScraper._tatsu_cache[key]
+
+    @staticmethod
+    def _set_ipsw_api(devices: list, validators: dict, fetched: float) -> None:
+        WikiScraper._ipsw_devices = {d['identifier'].casefold(): d for d in devices}
+        WikiScraper._ipsw_api = devices
+        WikiScraper._ipsw_api_validators = validators
+        WikiScraper._ipsw_api_time = fetched
+
+    @staticmethod
+    async def _load_ipsw_api() -> None:
+        if not await IPSW_API_CACHE.exists():
+            return
+
+        mtime = (await IPSW_API_CACHE.stat()).st_mtime
+        if time.time() - mtime > IPSW_API_CACHE_TTL:  # Too old to be worth keeping
+            return
+
+        try:
+            cache = orjson.loads(await IPSW_API_CACHE.read_bytes())
+            WikiScraper._set_ipsw_api(cache['devices'], cache['validators'], mtime)
+        except (orjson.JSONDecodeError, KeyError, TypeError):  # Unreadable, refetch
+            pass
+
+    @staticmethod
+    async def _save_ipsw_api() -> None:
+        await IPSW_API_CACHE.write_bytes(
+            orjson.dumps(
+                {
+                    'devices': WikiScraper._ipsw_api,
+                    'validators': WikiScraper._ipsw_api_validators,
+                }
+            )
+        )  # Validators are kept so a restart can still revalidate instead of refetch
+
+    async def get_ipsw_api(self) -> list:
+        if WikiScraper._ipsw_api_lock is None:
+            WikiScraper._ipsw_api_lock = asyncio.Lock()
+
+        async with WikiScraper._ipsw_api_lock:  # Only one coroutine fetches on a miss
+            if WikiScraper._ipsw_api is None:
+                await WikiScraper._load_ipsw_api()
+
+            if time.time() - WikiScraper._ipsw_api_time > IPSW_API_TTL:
+                try:
+                    async with self.session.get(
+                        IPSW_API, headers=WikiScraper._ipsw_api_validators
+                    ) as resp:
+                        if resp.status == 304:  # Our copy is still current
+                            WikiScraper._ipsw_api_time = time.time()
+                            if await IPSW_API_CACHE.exists():
+                                await IPSW_API_CACHE.touch()
+                            else:
+                                await WikiScraper._save_ipsw_api()
+
+                        elif resp.status == 200:
+                            WikiScraper._set_ipsw_api(
+                                orjson.loads(await resp.read()),
+                                {
+                                    request: resp.headers[response]
+                                    for request, response in IPSW_API_VALIDATORS
+                                    if response in resp.headers
+                                },
+                                time.time(),
+                            )
+                            await WikiScraper._save_ipsw_api()
+
+                        elif WikiScraper._ipsw_api is None:  # Nothing to fall back on
+                            resp.raise_for_status()
+
+                        else:  # Keep using the stale copy until the next refresh
+                            WikiScraper._ipsw_api_time = time.time()
+
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    if WikiScraper._ipsw_api is None:  # Nothing to fall back on
+                        raise
+
+                    # Keep using the stale copy until the next refresh
+                    WikiScraper._ipsw_api_time = time.time()
+
+        return WikiScraper._ipsw_api
+
+    async def get_ipsw_device(self, identifier: str) -> dict:
+        await self.get_ipsw_api()
+        return WikiScraper._ipsw_devices[identifier.casefold()]
+
+    async def get_pages(self, product_type: str) -> None:
         params = {
             'action': 'query',
-            'list': 'search',
-            'srsearch': f'Beta Firmware/{product_type}',
-            'srwhat': 'title',
-            'srlimit': 'max',
+            'generator': 'search',
+            'gsrsearch': f'Beta Firmware/{product_type}',
+            'gsrwhat': 'title',
+            'gsrlimit': 'max',
+            'prop': 'info',  # Pages' touched timestamps come back with the results
             'format': 'json',
+            'formatversion': 2,
         }
 
-        async with self.http_semaphore:
-            async with self.session.get(
-                'https://www.theiphonewiki.com/w/api.php', params=params
-            ) as resp:
-                if resp.status != 200:
-                    pass  # raise error
-                else:
-                    data = await resp.json()
-
-        for page in data['query']['search']:
-            if '.x' not in page['title']:  # We skip these pages:
-                continue
+        min_major_ver = 9 if 'Apple TV' not in product_type else 7
+        while True:
+            async with self.session.get(WIKI_API, params=params) as resp:
+                data = await resp.json(loads=orjson.loads)
 
-            major_ver = int(page['title'].split('/')[2][:-2])
-            min_major_ver = 9 if 'Apple TV' not in product_type else 7
-            if major_ver <= min_major_ver:
-                continue
+            for page in data.get('query', dict()).get('pages', list()):
+                if '.x' not in page['title']:  # We skip these pages:
+                    continue
+
+                major_ver = int(page['title'].split('/')[2][:-2])
+                if major_ver <= min_major_ver:
+                    continue
+
+                self.pages[page['title']] = page.get('touched')
+
+            if 'continue' not in data:  # No more search results
+                break
 
-            if page['title'] not in self.pages:
-                self.pages.append(page['title'])
+            params.update(data['continue'])
 
-    async def parse_page(self, title: str) -> dict:  # i hate this entire function
+    async def get_wikitext(self, titles: list) -> dict:
         params = {
-            'action': 'parse',
-            'prop': 'wikitext',
-            'page': title,
+            'action': 'query',
+            'prop': 'revisions',
+            'rvprop': 'content',
+            'titles': '|'.join(titles),
             'format': 'json',
             'formatversion': 2,
         }
 
-        async with self.http_semaphore:
-            async with self.session.get(
-                'https://www.theiphonewiki.com/w/api.php', params=params
-            ) as resp:
-                if resp.status != 200:
-                    pass  # raise error
-
-                data = await resp.json()
-
-        page_text = wtp.parse(data['parse']['wikitext'])
-        for table in page_text.tables:
-            template = table.data()[0]
-            for firm in range(1, len(table.data())):
-                firm_data = [x for x in table.data()[firm] if x is not None]
-                devices = list()
-
-                for device in wtp.parse(
-                    firm_data[
-                        next(
-                            template.index(x)
-                            for x in template
-                            if any(i in x for i in ('Codename', 'Keys'))
-                        )
-                    ]
-                ).wikilinks:
-                    regex = DEVICE_REGEX.match(str(device.text))
-                    if regex is not None:
-                        devices.append(regex.group())
-
-                firm = {'version': firm_data[0]}
-
-                version = wtp.parse(firm['version'])
-                if version.wikilinks:
-                    for link in version.wikilinks:
-                        if link.text is not None:
-                            firm['version'] = firm['version'].replace(
-                                str(link), link.text
-                            )
+        wikitext = dict()
+        while True:
+            async with self.session.get(WIKI_API, params=params) as resp:
+                data = await resp.json(loads=orjson.loads)
+
+            for page in data['query']['pages']:
+                if 'revisions' in page:  # Missing if the result size limit was hit
+                    wikitext[page['title']] = page['revisions'][0]['content']
+
+            if 'continue' not in data:  # Every page's content has been returned
+                break
+
+            params.update(data['continue'])
+
+        return wikitext
+
+    async def parse_pages(self) -> None:
+        changed = [
+            page
+            for page, touched in self.pages.items()
+            if touched is None
+            or WikiScraper._page_cache.get(page, (None,))[0] != touched
+        ]  # Only pages that have been edited since they were last parsed
+        wikitext = dict()
+        for batch in await asyncio.gather(
+            *[
+                self.get_wikitext(changed[i : i + WIKI_TITLE_LIMIT])
+                for i in range(0, len(changed), WIKI_TITLE_LIMIT)
+            ]
+        ):
+            wikitext.update(batch)
 
-                buildids = firm_data[1].split(
-                    '   | '
-                )  # Can't use the mediawiki parser for this, unfortunately
-                if len(buildids) > 1:
-                    buildids.pop(0)
-                    buildids.pop(-1)
-                    for b in range(len(buildids)):
-                        buildids[b] = buildids[b].split(' = ')[-1][:-1]
+        await asyncio.gather(
+            *[
+                self.parse_page(page, self.pages[page], wikitext[page])
+                for page in changed
+                if page in wikitext
+            ]
+        )
 
-                try:
-                    ipsws = next(
-                        wtp.parse(item).external_links
-                        for item in firm_data
-                        if wtp.parse(item).external_links
-                    )
-                except:  # No URLs for this firmware, skip
-                    continue
+        for page in self.pages:
+            if page not in WikiScraper._page_cache:
+                continue
 
-                if not any(
-                    ipsw.url.endswith('.ipsw') for ipsw in ipsws
-                ):  # Only IPSW beta firmwares are scraped
+            for firm in WikiScraper._page_cache[page][1]:
+                if firm['buildid'] in self.buildids[firm['identifier']]:
                     continue
 
-                ipsw_sizes = list()
-                for word in [
-                    x.replace(',', '').replace('\n', '')
-                    for x in firm_data[-1].split(' ')
-                ]:
-                    if (word.isnumeric()) and (int(word) > 10):
-                        ipsw_sizes.append(int(word))
-
-                if len(ipsw_sizes) != len(
-                    ipsws
-                ):  # One or more IPSWs don't have filesizes, skip
-                    continue
+                self.buildids[firm['identifier']].add(firm['buildid'])
+                # Signing checks modify firmwares, so don't share the cached ones
+                self.api[firm['identifier']].append(dict(firm))
 
-                for d in range(len(devices)):
-                    firm['identifier'] = devices[d]
-                    firm_index = (
-                        0
-                        if ((len(devices) == 4) and (d in (0, 1)))
-                        or ((len(devices) == 2) and (d == 0))
-                        else 1
-                    )
-                    firm['buildid'] = buildids[0]
-                    if len(buildids) > 1:
-                        firm['buildid'] = buildids[firm_index]
-
-                    firm['url'] = ipsws[0].url
-                    firm['filesize'] = ipsw_sizes[0]
-
-                    if len(ipsws) > 1:
-                        firm['url'] = ipsws[firm_index].url
-                        firm['filesize'] = ipsw_sizes[firm_index]
-
-                    if len(firm.keys()) < 4:  # Incomplete firmware info, skipping
-                        continue
-
-                    if devices[d] not in self.api.keys():
-                        self.api[devices[d]] = list()
-
-                    if not any(
-                        f['buildid'] == firm['buildid'] for f in self.api[devices[d]]
-                    ):
-                        self.api[devices[d]].append(firm)
-
-    def _sync_get_manifest(self, firm: dict) -> Optional[bytes]:
-        try:
-            with RemoteZip(firm['url']) as ipsw:
-                return ipsw.read(
-                    next(f for f in ipsw.namelist() if 'BuildManifest' in f)
-                )
-        except:
+    async def parse_page(
+        self, title: str, touched: Optional[str], wikitext: str
+    ) -> None:
+        firms = await asyncio.get_running_loop().run_in_executor(
+            self.pool, parse_wikitext, wikitext
+        )  # Parsing is CPU-bound, so keep it off the event loop
+        WikiScraper._page_cache[title] = (touched, firms)
+
+    async def _get_range(self, url: str, byte_range: str) -> Optional[tuple]:
+        async with self.session.get(
+            url, headers={'Range': f'bytes={byte_range}'}
+        ) as resp:
+            if resp.status != 206:  # Never download an entire IPSW
+                return None
+
+            start = resp.headers['Content-Range'].split(' ')[1].split('-')[0]
+            return int(start), await resp.read()
+
+    async def _get_zip_manifest(self, firm: dict) -> Optional[bytes]:
+        tail = await self._get_range(firm['url'], f'-{ZIP_TAIL_SIZE}')
+        if tail is None:
             return None
 
-    async def _get_manifest(self, firm: dict) -> Optional[bytes]:
-        async with self.http_semaphore:
-            async with self.session.get(
-                f"{'/'.join(firm['url'].split('/')[:-1])}/BuildManifest.plist"
-            ) as resp:
-                if resp.status == 200:
-                    return await resp.read()
-
-        async with self.http_semaphore:
-            async with self.session.get(firm['url']) as resp:
-                if resp.status == 200:
-                    return await asyncio.to_thread(self._sync_get_manifest, firm)
+        tail_start, tail_data = tail
+        eocd = tail_data.rfind(b'PK\x05\x06')
+        if eocd == -1:
+            return None
+
+        *_, cd_size, cd_offset, _ = ZIP_EOCD.unpack_from(tail_data, eocd)
+
+        locator = eocd - ZIP64_EOCD_LOCATOR.size
+        if locator >= 0 and tail_data.startswith(b'PK\x06\x07', locator):  # ZIP64
+            zip64_eocd = ZIP64_EOCD_LOCATOR.unpack_from(tail_data, locator)[2]
+            if zip64_eocd < tail_start:
+                return None
+
+            *_, cd_size, cd_offset = ZIP64_EOCD.unpack_from(
+                tail_data, zip64_eocd - tail_start
+            )
+
+        if cd_offset >= tail_start:
+            cd = tail_data[cd_offset - tail_start : cd_offset - tail_start + cd_size]
+        else:
+            cd_range = await self._get_range(
+                firm['url'], f'{cd_offset}-{cd_offset + cd_size - 1}'
+            )
+            if cd_range is None:
+                return None
+
+            cd = cd_range[1]
 
+        pos = 0
+        while pos + ZIP_CD_ENTRY.size <= len(cd):
+            entry = ZIP_CD_ENTRY.unpack_from(cd, pos)
+            name_start = pos + ZIP_CD_ENTRY.size
+            if b'BuildManifest' in cd[name_start : name_start + entry[10]]:
+                break
+
+            pos = name_start + sum(entry[10:13])  # Name, extra field & comment
+        else:
             return None
 
-    async def check_firmware(self, device: dict, firm: dict) -> None:
+        extra_start = name_start + entry[10]
+        method = entry[4]
+        comp_size, offset = _zip64_entry_info(
+            entry, cd[extra_start : extra_start + entry[11]]
+        )
+        data = None
+        if offset >= tail_start:  # Entries near the end of the IPSW are in the tail
+            data = _zip_local_data(tail_data[offset - tail_start :], comp_size)
+
+        if data is None:
+            local_size = ZIP_LOCAL_HEADER.size + entry[10] + 0xFFFF + comp_size
+            local_range = await self._get_range(
+                firm['url'], f'{offset}-{offset + local_size - 1}'
+            )  # The local extra field's length is only known once it's been read
+            if local_range is None:
+                return None
+
+            data = _zip_local_data(local_range[1], comp_size)
+            if data is None:
+                return None
+
+        if method == 8:  # Deflate
+            return zlib.decompressobj(-15).decompress(data)
+
+        return data if method == 0 else None
+
+    async def _get_manifest(self, firm: dict) -> Optional[bytes]:
+        async with self.session.get(
+            f"{'/'.join(firm['url'].split('/')[:-1])}/BuildManifest.plist"
+        ) as resp:
+            if resp.status == 200:
+                return await resp.read()
+
+        return await self._get_zip_manifest(firm)
+
+    async def _load_identities(self, firm: dict) -> list:
+        manifest = _fast_plist_loads(await self._get_manifest(firm))
+        return [
+            (
+                i['Info']['DeviceClass'].casefold(),
+                i['Info']['RestoreBehavior'],
+                i['UniqueBuildID'],
+            )
+            for i in manifest['BuildIdentities']
+            if 'RestoreBehavior' in i['Info']
+        ]  # Only keep what signing checks need, parsed manifests are huge
+
+    async def get_identities(self, firm: dict) -> list:
+        if firm['url'] not in self.identities:  # Devices sharing an IPSW share a fetch
+            self.identities[firm['url']] = asyncio.ensure_future(
+                self._load_identities(firm)
+            )
+
+        return await self.identities[firm['url']]
+
+    async def _query_tatsu(self, tss_request: dict) -> bool:
+        async with self.session.post(
+            TATSU_API,
+            data=plistlib.dumps(tss_request),
+            headers=TATSU_HEADERS,
+            params=TATSU_PARAMS,
+        ) as resp:
+            return 'MESSAGE=SUCCESS' in await resp.text()
+
+    async def check_firmware(
+        self, device: dict, boardconfig: str, firm: dict
+    ) -> Optional[dict]:
+        key = (device['cpid'], device['bdid'], firm['url'])
+        cached = WikiScraper._tatsu_cache.get(key)
+        if (
+            cached is not None and time.time() - cached[0] < TATSU_CACHE_TTL
+        ):  # Skips fetching the BuildManifest as well as asking Tatsu
+            if cached[1] is None:  # Don't retry a broken IPSW every cycle
+                return None
+
+            firm['signed'] = cached[1]
+            return firm
+
         tss_request = dict(TATSU_REQUEST)
         tss_request['ApChipID'] = device['cpid']
         tss_request['ApBoardID'] = device['bdid']
@@ -230,74 +640,79 @@ class WikiScraper:
             tss_request['SepNonce'] = b'0'
 
         try:
-            manifest = plistlib.loads(await self._get_manifest(firm))
-
-            for i in manifest['BuildIdentities']:
-                if 'RestoreBehavior' not in i['Info'].keys():
-                    continue
+            identities = await self.get_identities(firm)
+        except:
+            WikiScraper._tatsu_cache[key] = (time.time(), None)
+            return None
 
-                if (
-                    i['Info']['DeviceClass'].casefold()
-                    == device['boardconfig'].casefold()
-                    and i['Info']['RestoreBehavior'] == 'Erase'
-                ):
-                    identity = i
-                    break
+        for device_class, restore_behavior, unique_buildid in identities:
+            if device_class == boardconfig and restore_behavior == 'Erase':
+                break
 
-            else:
-                self.api[device['identifier']].remove(firm)
-                return
+        else:
+            WikiScraper._tatsu_cache[key] = (time.time(), None)
+            return None
 
-        except:
-            self.api[device['identifier']].remove(firm)
-            return
+        tss_request['UniqueBuildID'] = unique_buildid
 
-        tss_request['UniqueBuildID'] = identity['UniqueBuildID']
-
-        async with self.http_semaphore:
-            async with self.session.post(
-                TATSU_API,
-                data=plistlib.dumps(tss_request),
-                headers=TATSU_HEADERS,
-                params=TATSU_PARAMS,
-            ) as resp:
-                firm_index = self.api[device['identifier']].index(firm)
-                self.api[device['identifier']][firm_index]['signed'] = (
-                    'MESSAGE=SUCCESS' in await resp.text()
-                )
+        firm['signed'] = await self._query_tatsu(tss_request)
+        WikiScraper._tatsu_cache[key] = (time.time(), firm['signed'])
+        return firm
 
     async def check_device_signed_firmwares(self, identifier: str) -> None:
-        if self.ipsw_api is None:
-            async with self.http_semaphore:
-                async with self.session.get('https://api.ipsw.me/v4/devices') as resp:
-                    self.ipsw_api = await resp.json()
-
-        device = next(
-            d
-            for d in self.ipsw_api
-            if d['identifier'].casefold() == identifier.casefold()
+        device = await self.get_ipsw_device(identifier)
+        boardconfig = device['boardconfig'].casefold()
+
+        firms = await asyncio.gather(
+            *[
+                self.check_firmware(device, boardconfig, firm)
+                for firm in self.api[identifier]
+            ]
         )
+        self.api[identifier] = [
+            firm for firm in firms if firm is not None
+        ]  # Drop firmwares that couldn't be checked
+
+    async def output_data(self) -> None:
+        rows = list()
+        for identifier, firms in self.api.items():
+            firms.sort(key=operator.itemgetter('buildid'), reverse=True)
+            # Stored as bytes so the API can return it as-is
+            row = (orjson.dumps(firms), identifier.lower())
+            if WikiScraper._output_cache.get(row[1]) != row[0]:
+                rows.append(row)
+
+        if not rows:  # Every device's row is already up to date
+            return
 
-        await asyncio.gather(
-            *[self.check_firmware(device, firm) for firm in self.api[identifier]]
+        await self.db.executemany(
+            '''
+        INSERT INTO betas(firmwares, identifier) VALUES (?,?)
+        ON CONFLICT(identifier) DO UPDATE SET firmwares = excluded.firmwares
+        ''',
+            rows,
         )
+        await self.db.commit()  # One transaction for every changed device
 
-        await self.output_device_data(identifier)
+        for firmwares, identifier in rows:
+            WikiScraper._output_cache[identifier] = firmwares
 
-    async def output_device_data(self, identifier: str) -> None:
-        json_data = ujson.dumps(
-            sorted(self.api[identifier], key=lambda firm: firm['buildid'], reverse=True)
-        )
-        async with self.db.execute(
-            'SELECT * FROM betas WHERE identifier = ?', (identifier.lower(),)
-        ) as cursor:
-            if await cursor.fetchone() is not None:
-                sql = 'UPDATE betas SET firmwares = ? WHERE identifier = ?'
-            else:
-                sql = 'INSERT INTO betas(firmwares, identifier) VALUES (?,?)'
 
-        await self.db.execute(sql, (json_data, identifier.lower()))
-        await self.db.commit()
+async def init_db(db: aiosqlite.Connection) -> None:
+    await db.execute('PRAGMA journal_mode=WAL')
+    await db.execute('PRAGMA synchronous=NORMAL')
+    await db.execute(
+        '''
+    CREATE TABLE IF NOT EXISTS betas(
+    identifier TEXT,
+    firmwares BLOB
+    )
+    '''
+    )
+    await db.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS betas_identifier ON betas(identifier)'
+    )
+    await db.commit()
 
 
 app = FastAPI()
@@ -306,15 +721,16 @@ app = FastAPI()
 @app.on_event('startup')
 async def app_startup():
     async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            '''
-        CREATE TABLE IF NOT EXISTS betas(
-        identifier TEXT,
-        firmwares JSON
-        )
-        '''
-        )
-        await db.commit()
+        await init_db(db)
+
+    # The API only ever reads, so share a single read-only connection
+    app.state.db = await aiosqlite.connect(f'file:{DB_PATH}?mode=ro', uri=True)
+    await app.state.db.execute('PRAGMA query_only=ON')
+
+
+@app.on_event('shutdown')
+async def app_shutdown():
+    await app.state.db.close()
 
 
 @app.middleware("http")
@@ -326,66 +742,79 @@ async def add_process_time_header(request, call_next):
 
 
 @app.get('/betas/{identifier}')
-async def get_firmwares(identifier: str) -> str:
-    async with aiosqlite.connect(DB_PATH) as db, db.execute(
+async def get_firmwares(identifier: str) -> Response:
+    async with app.state.db.execute(
         'SELECT firmwares FROM betas WHERE identifier = ?', (identifier.lower(),)
     ) as cursor:
         firmwares = await cursor.fetchone()
 
-    try:
-        return ujson.loads(firmwares[0])
-    except:
+    if firmwares is None:
         raise HTTPException(
             status_code=404, detail=f"Device identifier not found: '{identifier}'."
         )
 
+    return Response(content=firmwares[0], media_type='application/json')
 
-async def main() -> None:
-    async with aiohttp.ClientSession() as session, aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            '''
-        CREATE TABLE IF NOT EXISTS betas(
-        identifier TEXT,
-        firmwares JSON
-        )
-        '''
-        )
-        await db.commit()
 
-        while True:
-            scraper = WikiScraper(session, db)
-            await asyncio.gather(
-                *[
-                    scraper.get_pages(product)
-                    for product in (
-                        'Apple TV',
-                        'iPod touch',
-                        'iPhone',
-                        'iPad',
-                        'iPad Air',
-                        'iPad Pro',
-                        'iPad Mini',
-                    )
-                ]
-            )
+async def main() -> None:
+    connector = aiohttp.TCPConnector(
+        limit=100,  # Only allow 100 simultaneous HTTP requests
+        limit_per_host=30,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+        enable_cleanup_closed=True,
+    )  # Reuse keep-alive connections and DNS results across scrape cycles
+    async with aiohttp.ClientSession(
+        connector=connector
+    ) as session, aiosqlite.connect(DB_PATH) as db:
+        await init_db(db)
+
+        with concurrent.futures.ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context('spawn')
+        ) as pool:  # Forking now would copy aiosqlite's running thread into workers
+            while True:
+                WikiScraper.prune_tatsu_cache()
+                scraper = WikiScraper(session, db, pool)
+                await asyncio.gather(
+                    *[
+                        scraper.get_pages(product)
+                        for product in (
+                            'Apple TV',
+                            'iPod touch',
+                            'iPhone',
+                            'iPad',
+                            'iPad Air',
+                            'iPad Pro',
+                            'iPad Mini',
+                        )
+                    ]
+                )
 
-            await asyncio.gather(*[scraper.parse_page(page) for page in scraper.pages])
+                await scraper.parse_pages()
 
-            for device in scraper.api.keys():
-                await scraper.check_device_signed_firmwares(device)
+                await asyncio.gather(
+                    *[
+                        scraper.check_device_signed_firmwares(device)
+                        for device in scraper.api
+                    ]
+                )
 
-            async with session.get('https://api.ipsw.me/v4/devices') as resp:
-                ipsw_api = await resp.json()
+                for device in [
+                    d['identifier'] for d in await scraper.get_ipsw_api()
+                ]:  # Add the rest of the device
+                    if device not in scraper.api and _device_token(device) is not None:
+                        scraper.api[device] = list()
 
-            for device in [
-                d['identifier'] for d in ipsw_api
-            ]:  # Add the rest of the device
-                if (
-                    device not in scraper.api.keys()
-                    and DEVICE_REGEX.match(device) is not None
-                ):
-                    scraper.api[device] = list()
+                await scraper.output_data()
+                await asyncio.sleep(SCRAPE_INTERVAL)
 
 
 if __name__ == '__main__':
+    try:
+        import uvloop
+    except ImportError:  # Fall back to the default event loop
+        pass
+    else:
+        uvloop.install()
+
     asyncio.run(main())